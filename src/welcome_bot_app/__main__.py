@@ -79,7 +79,9 @@ async def main() -> None:
     event_queue = SqliteEventQueue(
         db_path=args.args().event_queue_file, options=SqliteEventQueue.Options()
     )
-    event_log = bot_api_loop.EventLog(args.args().event_log_file)
+    event_log = bot_api_loop.EventLog(
+        args.args().event_log_file, options=bot_api_loop.EventLog.Options()
+    )
     bot_storage = BotStorage(args.args().storage_url, enable_echo=args.args().log_sql)
     event_processor = EventProcessor(
         EventProcessor.Config(),
@@ -97,6 +99,7 @@ async def main() -> None:
         )
     )
     all_tasks.append(asyncio.create_task(event_processor.run()))
+    all_tasks.append(asyncio.create_task(event_log.flush_periodically()))
 
     if telethon_client is not None:
         all_tasks.append(
@@ -117,6 +120,8 @@ async def main() -> None:
     for task in pending:
         task.cancel()
     await asyncio.gather(*pending, return_exceptions=True)
+    event_log.close()
+    event_queue.close()
 
 
 if __name__ == "__main__":
@@ -4,7 +4,6 @@ from aiogram import Bot, Dispatcher
 import time
 import logging
 import asyncio
-from datetime import timezone
 from welcome_bot_app.event_queue import BaseEventQueue
 from welcome_bot_app.model.events import (
     BotApiChatInfo,
@@ -49,9 +48,7 @@ def extract_bot_events_from_message(
                 recv_timestamp=recv_timestamp,
                 user_chat_id=user_chat_id,
                 basic_user_info=basic_user_info,
-                tg_timestamp=BotApiUTCTimestamp(
-                    message.date.astimezone(timezone.utc).timestamp()
-                ),
+                tg_timestamp=BotApiUTCTimestamp(message.date.timestamp()),
                 chat_info=BotApiChatInfo.from_bot_api_chat(message.chat),
             )
     elif message.content_type == aiogram.types.ContentType.LEFT_CHAT_MEMBER:
@@ -67,9 +64,7 @@ def extract_bot_events_from_message(
                 user_id=UserId(message.left_chat_member.id),
                 chat_id=ChatId(message.chat.id),
             ),
-            tg_timestamp=BotApiUTCTimestamp(
-                message.date.astimezone(timezone.utc).timestamp()
-            ),
+            tg_timestamp=BotApiUTCTimestamp(message.date.timestamp()),
             chat_info=BotApiChatInfo.from_bot_api_chat(message.chat),
         )
     elif message_text is not None:
@@ -93,9 +88,7 @@ def extract_bot_events_from_message(
             text=message_text,
             is_edited=is_edited,
             message_id=BotApiMessageId(message.message_id),
-            tg_timestamp=BotApiUTCTimestamp(
-                message.date.astimezone(timezone.utc).timestamp()
-            ),
+            tg_timestamp=BotApiUTCTimestamp(message.date.timestamp()),
             chat_info=BotApiChatInfo.from_bot_api_chat(message.chat),
         )
 
@@ -120,9 +113,7 @@ def extract_bot_events_from_message_reaction(
         user_chat_id=user_chat_id,
         basic_user_info=basic_user_info,
         message_id=BotApiMessageId(message_reaction.message_id),
-        tg_timestamp=BotApiUTCTimestamp(
-            message_reaction.date.astimezone(timezone.utc).timestamp()
-        ),
+        tg_timestamp=BotApiUTCTimestamp(message_reaction.date.timestamp()),
         chat_info=BotApiChatInfo.from_bot_api_chat(message_reaction.chat),
         old_reaction=[
             BotApiReactionEmoji.from_bot_api_reaction(reaction)
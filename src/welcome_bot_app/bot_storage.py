@@ -1,5 +1,6 @@
 import sqlalchemy as sa
 import sqlite3
+from collections import OrderedDict
 import sqlalchemy.event as sa_event
 from typing import Any, List
 from welcome_bot_app.model.chat_settings import BotReplyType, ChatSettings
@@ -9,7 +10,6 @@ from welcome_bot_app.model.user_profile import (
     BotApiMessage,
     PresenceInfo,
     UserProfile,
-    UserProfileParams,
     UserChatCapabilities,
 )
 from welcome_bot_app.model import (
@@ -22,7 +22,18 @@ from welcome_bot_app.model import (
 
 
 class BotStorage:
-    def __init__(self, storage_url: str, enable_echo: bool = False) -> None:
+    def __init__(
+        self,
+        storage_url: str,
+        enable_echo: bool = False,
+        profile_cache_size: int = 512,
+    ) -> None:
+        # LRU cache of stored user_profile_json, None means that there is no stored profile.
+        # Kept up to date by save_profile(), assuming no one else writes to the database.
+        self._profile_cache: OrderedDict[UserChatId, str | None] = OrderedDict()
+        self._profile_cache_size = profile_cache_size
+        # Last chat info written by add_chat(), under the same assumption as the profile cache.
+        self._chat_info_cache: dict[ChatId, BotApiChatInfo] = {}
         self._engine = sa.create_engine(storage_url, echo=enable_echo)
         if self._engine.driver != "pysqlite":
             raise NotImplementedError(
@@ -105,10 +116,92 @@ class BotStorage:
         )
         self._sa_metadata.create_all(self._engine)
 
+        # Statements used on the hot path are built once, SQLAlchemy then reuses their compiled form.
+        self._get_profile_stmt = sa.select(
+            self._user_profiles.c.user_profile_json
+        ).where(
+            sa.and_(
+                self._user_profiles.c.user_id == sa.bindparam("user_id"),
+                self._user_profiles.c.chat_id == sa.bindparam("chat_id"),
+            )
+        )
+        insert_profile_stmt = sqlite_insert(self._user_profiles)
+        self._upsert_profile_stmt = insert_profile_stmt.on_conflict_do_update(
+            index_elements=[
+                self._user_profiles.c.user_id,
+                self._user_profiles.c.chat_id,
+            ],
+            set_=dict(
+                user_profile_json=insert_profile_stmt.excluded.user_profile_json,
+                kick_at_timestamp=insert_profile_stmt.excluded.kick_at_timestamp,
+            ),
+        )
+        # Most overdue first, so that a limited batch never starves anyone.
+        self._get_profiles_to_kick_stmt = (
+            sa.select(self._user_profiles.c.user_profile_json)
+            .where(
+                sa.and_(
+                    self._user_profiles.c.kick_at_timestamp.is_not(None),
+                    self._user_profiles.c.kick_at_timestamp
+                    <= sa.bindparam("current_timestamp"),
+                )
+            )
+            .order_by(self._user_profiles.c.kick_at_timestamp)
+            .limit(sa.bindparam("limit"))
+        )
+        # Only the columns used by _bot_message_from_row(), in its order.
+        self._get_bot_messages_stmt = sa.select(
+            self._bot_messages.c.user_id,
+            self._bot_messages.c.chat_id,
+            self._bot_messages.c.message_id,
+            self._bot_messages.c.reply_type,
+            self._bot_messages.c.sent_timestamp,
+        ).where(self._bot_messages.c.delete_timestamp.is_(None))
+        self._insert_bot_message_stmt = self._bot_messages.insert()
+        self._mark_bot_message_as_deleted_stmt = (
+            self._bot_messages.update()
+            .where(
+                sa.and_(
+                    self._bot_messages.c.message_id == sa.bindparam("b_message_id"),
+                    self._bot_messages.c.user_id == sa.bindparam("b_user_id"),
+                    self._bot_messages.c.chat_id == sa.bindparam("b_chat_id"),
+                    self._bot_messages.c.delete_timestamp.is_(None),
+                )
+            )
+            .values(delete_timestamp=sa.bindparam("b_delete_timestamp"))
+        )
+        self._get_chat_settings_stmt = sa.select(
+            self._chat_settings.c.chat_settings
+        ).where(self._chat_settings.c.chat_id == sa.bindparam("chat_id"))
+
     def _set_conn_pragmas(self, dbapi_con: sqlite3.Connection, con_record: Any) -> None:
+        # WAL lets readers (e.g. get_profiles_to_kick) run concurrently with writers (e.g. save_profile).
         dbapi_con.execute("PRAGMA journal_mode=WAL")
+        # NORMAL is durable enough in WAL mode and avoids an fsync on every commit.
+        dbapi_con.execute("PRAGMA synchronous=NORMAL")
+        dbapi_con.execute("PRAGMA temp_store=MEMORY")
+        # 64 MiB page cache.
+        dbapi_con.execute("PRAGMA cache_size=-65536")
+        # Reads come straight from the mapped file instead of being copied into the page cache.
+        dbapi_con.execute("PRAGMA mmap_size=268435456")
+        # Same as the default timeout of sqlite3.connect(), but explicit.
+        dbapi_con.execute("PRAGMA busy_timeout=5000")
+        dbapi_con.execute("PRAGMA wal_autocheckpoint=1000")
+
+    def optimize(self) -> None:
+        """Refreshes query planner statistics, should be called before shutdown."""
+        with self._engine.connect() as conn:
+            conn.exec_driver_sql("PRAGMA optimize")
+
+    def checkpoint(self) -> None:
+        """Moves the WAL into the database and truncates it, should be called periodically."""
+        with self._engine.connect() as conn:
+            conn.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)")
 
     def add_chat(self, chat_id: ChatId, chat_info: BotApiChatInfo) -> None:
+        # Called for every incoming message, but the chat info rarely changes.
+        if self._chat_info_cache.get(chat_id) == chat_info:
+            return
         with self._engine.connect() as conn:
             insert_stmt = (
                 sqlite_insert(self._bot_chats)
@@ -122,6 +215,7 @@ class BotStorage:
                 ),
             )
             conn.commit()
+        self._chat_info_cache[chat_id] = chat_info
 
     def get_chats(self) -> dict[ChatId, BotApiChatInfo]:
         with self._engine.connect() as conn:
@@ -137,14 +231,11 @@ class BotStorage:
                 self._bot_chats.delete().where(self._bot_chats.c.chat_id == chat_id)
             )
             conn.commit()
+        self._chat_info_cache.pop(chat_id, None)
 
     def get_chat_settings(self, chat_id: ChatId) -> ChatSettings:
         with self._engine.connect() as conn:
-            result = conn.execute(
-                self._chat_settings.select().where(
-                    self._chat_settings.c.chat_id == chat_id
-                )
-            )
+            result = conn.execute(self._get_chat_settings_stmt, dict(chat_id=chat_id))
             row = result.fetchone()
             if row is None:
                 return ChatSettings.get_default()
@@ -164,114 +255,115 @@ class BotStorage:
             conn.commit()
 
     def _bot_message_from_row(self, row: sa.Row[Any]) -> BotApiMessage:
+        user_id, chat_id, message_id, reply_type, sent_timestamp = row
         return BotApiMessage(
-            user_chat_id=UserChatId(
-                user_id=UserId(row.user_id), chat_id=ChatId(row.chat_id)
-            ),
-            message_id=BotApiMessageId(row.message_id),
-            reply_type=BotReplyType(row.reply_type),
-            sent_timestamp=LocalUTCTimestamp(row.sent_timestamp),
+            user_chat_id=UserChatId(user_id=UserId(user_id), chat_id=ChatId(chat_id)),
+            message_id=BotApiMessageId(message_id),
+            reply_type=BotReplyType(reply_type),
+            sent_timestamp=LocalUTCTimestamp(sent_timestamp),
         )
 
     def get_bot_messages(self) -> List[BotApiMessage]:
         with self._engine.connect() as conn:
-            result = conn.execute(
-                self._bot_messages.select().where(
-                    self._bot_messages.c.delete_timestamp.is_(None)
-                )
-            )
-            return [self._bot_message_from_row(row) for row in result]
+            # all() fetches the rows in one call instead of one fetchone() per row.
+            rows = conn.execute(self._get_bot_messages_stmt).all()
+        return [self._bot_message_from_row(row) for row in rows]
 
-    def mark_bot_message_as_deleted(
+    def mark_bot_messages_as_deleted(
         self,
-        user_chat_id: UserChatId,
-        message_id: BotApiMessageId,
+        bot_api_messages: List[BotApiMessage],
         delete_timestamp: LocalUTCTimestamp,
     ) -> None:
+        """Marks all messages as deleted in one transaction."""
+        if not bot_api_messages:
+            return
         with self._engine.connect() as conn:
             conn.execute(
-                self._bot_messages.update()
-                .where(
-                    sa.and_(
-                        self._bot_messages.c.message_id == message_id,
-                        self._bot_messages.c.user_id == user_chat_id.user_id,
-                        self._bot_messages.c.chat_id == user_chat_id.chat_id,
-                        self._bot_messages.c.delete_timestamp.is_(None),
+                self._mark_bot_message_as_deleted_stmt,
+                [
+                    dict(
+                        b_message_id=bot_api_message.message_id,
+                        b_user_id=bot_api_message.user_chat_id.user_id,
+                        b_chat_id=bot_api_message.user_chat_id.chat_id,
+                        b_delete_timestamp=delete_timestamp,
                     )
-                )
-                .values(delete_timestamp=delete_timestamp)
+                    for bot_api_message in bot_api_messages
+                ],
             )
             conn.commit()
 
     def add_bot_message(self, bot_api_message: BotApiMessage) -> None:
         with self._engine.connect() as conn:
             conn.execute(
-                self._bot_messages.insert().values(
+                self._insert_bot_message_stmt,
+                dict(
                     user_id=bot_api_message.user_chat_id.user_id,
                     chat_id=bot_api_message.user_chat_id.chat_id,
                     message_id=bot_api_message.message_id,
                     reply_type=bot_api_message.reply_type.value,
                     sent_timestamp=bot_api_message.sent_timestamp,
-                )
+                ),
             )
             conn.commit()
 
-    def get_users_to_kick(
-        self, current_timestamp: LocalUTCTimestamp
-    ) -> List[UserChatId]:
+    def get_profiles_to_kick(
+        self, current_timestamp: LocalUTCTimestamp, limit: int = 100
+    ) -> List[UserProfile]:
+        """Returns up to `limit` profiles of users whose kick_at_timestamp has passed, most overdue first."""
         with self._engine.connect() as conn:
             result = conn.execute(
-                self._user_profiles.select().where(
-                    sa.and_(
-                        self._user_profiles.c.kick_at_timestamp.is_not(None),
-                        self._user_profiles.c.kick_at_timestamp <= current_timestamp,
-                    )
-                )
+                self._get_profiles_to_kick_stmt,
+                dict(current_timestamp=current_timestamp, limit=limit),
             )
-            return [
-                UserChatId(user_id=row.user_id, chat_id=row.chat_id) for row in result
-            ]
+            profiles = []
+            for row in result:
+                profile = UserProfile.model_validate_json(row.user_profile_json)
+                self._cache_profile_json(profile.user_chat_id, row.user_profile_json)
+                profiles.append(profile)
+            return profiles
+
+    def _cache_profile_json(
+        self, user_chat_id: UserChatId, user_profile_json: str | None
+    ) -> None:
+        self._profile_cache[user_chat_id] = user_profile_json
+        self._profile_cache.move_to_end(user_chat_id)
+        if len(self._profile_cache) > self._profile_cache_size:
+            self._profile_cache.popitem(last=False)
 
     def get_profile(self, user_chat_id: UserChatId) -> UserProfile:
-        with self._engine.connect() as conn:
-            result = conn.execute(
-                self._user_profiles.select().where(
-                    sa.and_(
-                        self._user_profiles.c.user_id == user_chat_id.user_id,
-                        self._user_profiles.c.chat_id == user_chat_id.chat_id,
-                    )
+        try:
+            user_profile_json = self._profile_cache[user_chat_id]
+            self._profile_cache.move_to_end(user_chat_id)
+        except KeyError:
+            with self._engine.connect() as conn:
+                result = conn.execute(
+                    self._get_profile_stmt,
+                    dict(user_id=user_chat_id.user_id, chat_id=user_chat_id.chat_id),
                 )
-            )
-            row = result.fetchone()
-            if row is None:
-                return UserProfile(
-                    user_chat_id=user_chat_id, presence_info=PresenceInfo()
-                )
-            return UserProfile.model_validate_json(row.user_profile_json)
+                row = result.fetchone()
+            user_profile_json = None if row is None else row.user_profile_json
+            self._cache_profile_json(user_chat_id, user_profile_json)
+        if user_profile_json is None:
+            return UserProfile(user_chat_id=user_chat_id, presence_info=PresenceInfo())
+        return UserProfile.model_validate_json(user_profile_json)
 
     def save_profile(
-        self, profile: UserProfile, user_profile_params: UserProfileParams
+        self, profile: UserProfile, kick_at_timestamp: LocalUTCTimestamp | None
     ) -> None:
+        """Saves the profile, `kick_at_timestamp` must be computed by UserProfile.get_kick_at_timestamp()."""
+        user_profile_json = profile.model_dump_json()
         with self._engine.connect() as conn:
-            insert_stmt = sqlite_insert(self._user_profiles).values(
-                user_id=profile.user_chat_id.user_id,
-                chat_id=profile.user_chat_id.chat_id,
-                user_profile_json=profile.model_dump_json(indent=2),
-                kick_at_timestamp=profile.get_kick_at_timestamp(user_profile_params),
-            )
             conn.execute(
-                insert_stmt.on_conflict_do_update(
-                    index_elements=[
-                        self._user_profiles.c.user_id,
-                        self._user_profiles.c.chat_id,
-                    ],
-                    set_=dict(
-                        user_profile_json=insert_stmt.excluded.user_profile_json,
-                        kick_at_timestamp=insert_stmt.excluded.kick_at_timestamp,
-                    ),
+                self._upsert_profile_stmt,
+                dict(
+                    user_id=profile.user_chat_id.user_id,
+                    chat_id=profile.user_chat_id.chat_id,
+                    user_profile_json=user_profile_json,
+                    kick_at_timestamp=kick_at_timestamp,
                 ),
             )
             conn.commit()
+        self._cache_profile_json(profile.user_chat_id, user_profile_json)
 
     def get_chat_user_profiles(self, chat_id: ChatId) -> List[UserProfile]:
         with self._engine.connect() as conn:
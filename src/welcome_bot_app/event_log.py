@@ -1,20 +1,58 @@
 import sqlite3
+import concurrent.futures
+import aiogram.types
+from pydantic import BaseModel
 from welcome_bot_app.model import LocalUTCTimestamp
 from welcome_bot_app.model.events import BaseEvent, BotApiUpdate
-from typing import Any
+from typing import Any, Callable, List, Tuple
+import asyncio
 import logging
+import time
 
 
 class EventLog:
-    """Simple event log storage."""
+    """Simple event log storage.
 
-    def __init__(self, file_path: str) -> None:
-        self._conn = sqlite3.connect(file_path, isolation_level=None)
+    Events are buffered in memory and written in batches, see `Options`.
+    Writes happen on a dedicated single-threaded executor, so that they don't block the event loop
+    and are applied in order. Immutable objects are rendered to text on that executor as well."""
+
+    class Options(BaseModel):
+        # Write buffered events once there are at least `flush_batch_size` of them.
+        flush_batch_size: int = 64
+        # Write buffered events at least every `flush_interval` seconds.
+        flush_interval: float = 2.0
+        # Refresh query planner statistics every `optimize_interval` seconds.
+        optimize_interval: float = 6 * 60 * 60
+
+    def __init__(self, file_path: str, options: Options) -> None:
+        self._options = options
+        # The connection is used from the writer thread after initialization.
+        self._conn = sqlite3.connect(
+            file_path, isolation_level=None, check_same_thread=False
+        )
         self._initialize_database()
+        self._writer = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="EventLogWriter"
+        )
+        # Rows that are not yet written to the database: timestamp, event type, object and function rendering it to text.
+        self._buffer: List[
+            Tuple[LocalUTCTimestamp, str, Any, Callable[[Any], str]]
+        ] = []
+        self._last_flush_time = time.monotonic()
 
     def _initialize_database(self) -> None:
         self._conn.execute("PRAGMA strict=ON")
         self._conn.execute("PRAGMA journal_mode=wal")
+        # With WAL, synchronous=NORMAL could lose the last transactions on power loss, but never corrupts the database.
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA temp_store=MEMORY")
+        # Negative value is in KiB.
+        self._conn.execute("PRAGMA cache_size=-20000")
+        self._conn.execute("PRAGMA mmap_size=268435456")
+        if sqlite3.sqlite_version_info < (3, 46, 0):
+            # Bound the work done by PRAGMA optimize, newer SQLite versions do this automatically.
+            self._conn.execute("PRAGMA analysis_limit=1000")
         self._conn.execute(
             """
                 CREATE TABLE IF NOT EXISTS EventLog (
@@ -25,44 +63,102 @@ class EventLog:
                 )
             """
         )
+        self._conn.execute("PRAGMA optimize")
 
     def log_event(
         self, recv_timestamp: LocalUTCTimestamp, event_type: str, event_data: str
     ) -> None:
+        self._log_object(recv_timestamp, event_type, event_data, str)
+
+    def _log_object(
+        self,
+        recv_timestamp: LocalUTCTimestamp,
+        event_type: str,
+        obj: Any,
+        render: Callable[[Any], str],
+    ) -> None:
+        """Logs the object, which is rendered with `render` on the writer thread, so it must not be modified later."""
+        self._buffer.append((recv_timestamp, event_type, obj, render))
+        if (
+            len(self._buffer) >= self._options.flush_batch_size
+            or time.monotonic() - self._last_flush_time >= self._options.flush_interval
+        ):
+            self.flush()
+
+    def flush(self) -> None:
+        """Schedules writing of all buffered events to the database in a single transaction."""
+        self._last_flush_time = time.monotonic()
+        if not self._buffer:
+            return
+        rows, self._buffer = self._buffer, []
+        self._writer.submit(self._write_rows, rows)
+
+    def close(self) -> None:
+        """Writes all buffered events and waits for the pending writes to finish."""
+        self.flush()
+        self._writer.shutdown(wait=True)
+        self._conn.execute("PRAGMA optimize")
+        self._conn.close()
+
+    def _write_rows(
+        self, entries: List[Tuple[LocalUTCTimestamp, str, Any, Callable[[Any], str]]]
+    ) -> None:
+        rows = []
+        for recv_timestamp, event_type, obj, render in entries:
+            try:
+                rows.append((recv_timestamp, event_type, render(obj)))
+            except Exception:
+                logging.error("Failed to render %s: %r", event_type, obj, exc_info=True)
         try:
             cursor = self._conn.cursor()
-            cursor.execute(
-                """
-                    INSERT INTO EventLog (recv_timestamp, event_type, event_data)
-                    VALUES (?, ?, ?)
-                """,
-                (recv_timestamp, event_type, event_data),
-            )
+            cursor.execute("BEGIN TRANSACTION")
+            try:
+                cursor.executemany(
+                    """
+                        INSERT INTO EventLog (recv_timestamp, event_type, event_data)
+                        VALUES (?, ?, ?)
+                    """,
+                    rows,
+                )
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+            else:
+                cursor.execute("COMMIT")
         except Exception:
-            logging.error(
-                "Failed to log raw Bot API event: event_type: %r, event_data: %r",
-                event_type,
-                event_data,
-                exc_info=True,
-            )
+            logging.error("Failed to log %d events: %r", len(rows), rows, exc_info=True)
+
+    async def flush_periodically(self) -> None:
+        """Flushes buffered events every `flush_interval` seconds, runs until cancelled."""
+        last_optimize_time = time.monotonic()
+        while True:
+            await asyncio.sleep(self._options.flush_interval)
+            self.flush()
+            if time.monotonic() - last_optimize_time >= self._options.optimize_interval:
+                last_optimize_time = time.monotonic()
+                self._writer.submit(self._conn.execute, "PRAGMA optimize")
 
     # Below go helper methods for keeping all logging logic in one place.
     def log_bot_api_update(
         self, recv_timestamp: LocalUTCTimestamp, update: BotApiUpdate
     ) -> None:
         try:
+            event_data: aiogram.types.TelegramObject
             if update.message is not None:
                 event_type = "BOT_API/MSG"
-                event_data = str(update.message)
+                event_data = update.message
             elif update.edited_message is not None:
                 event_type = "BOT_API/MSG_EDIT"
-                event_data = str(update.edited_message)
+                event_data = update.edited_message
             elif update.message_reaction is not None:
                 event_type = "BOT_API/MSG_REACTION"
-                event_data = str(update.message_reaction)
+                event_data = update.message_reaction
             else:
                 raise RuntimeError("Unexpected update:", update)
-            self.log_event(recv_timestamp, event_type, event_data)
+            # Bot API objects are frozen, so they could be rendered later.
+            self._log_object(
+                recv_timestamp, event_type, event_data, _render_bot_api_object
+            )
         except Exception:
             logging.error("Failed to log raw Bot API update: %s", update, exc_info=True)
 
@@ -80,7 +176,16 @@ class EventLog:
     ) -> None:
         try:
             event_type = "BASE/" + type(event).__name__
-            event_data = event.model_dump_json(indent=2)
-            self.log_event(recv_timestamp, event_type, event_data)
+            # Events are not modified after they are created.
+            self._log_object(recv_timestamp, event_type, event, _render_base_event)
         except Exception:
             logging.error("Failed to log event: %s", event, exc_info=True)
+
+
+def _render_bot_api_object(obj: aiogram.types.TelegramObject) -> str:
+    # Most of the fields are None, so skipping them makes the log entries much smaller and faster to render.
+    return obj.model_dump_json(exclude_none=True)
+
+
+def _render_base_event(event: BaseEvent) -> str:
+    return event.model_dump_json()
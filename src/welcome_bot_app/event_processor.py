@@ -1,11 +1,23 @@
 import asyncio
 import difflib
+import functools
 import logging
 import time
 import traceback
 import html
 from collections import defaultdict
-from typing import DefaultDict, Iterable, Iterator, List, Optional
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    DefaultDict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    ParamSpec,
+    TypeVar,
+)
 import aiogram
 import aiogram.exceptions
 from pydantic import BaseModel
@@ -29,11 +41,12 @@ from welcome_bot_app.model.user_profile import (
 )
 from welcome_bot_app.safe_html import (
     escape_html,
-    safe_html_format,
+    html_template_placeholders,
     safe_html_str,
     substitute_html,
 )
 from welcome_bot_app.bot_storage import BotStorage
+from welcome_bot_app.rate_limiter import RateLimiter
 from welcome_bot_app.event_queue import BaseEventQueue
 from welcome_bot_app.model.events import (
     BaseEvent,
@@ -46,23 +59,36 @@ from welcome_bot_app.model.events import (
 
 from aiogram.enums.parse_mode import ParseMode
 
+_P = ParamSpec("_P")
+_T = TypeVar("_T")
+
+# Bot API limit for a single deleteMessages call.
+_MAX_MESSAGES_PER_DELETE = 100
+# Bot API methods that are safe to repeat after a network error, e.g. when the first call succeeded but the response was lost.
+# send_message is not among them, as the message would be posted twice.
+_IDEMPOTENT_BOT_API_METHODS = frozenset(
+    ["ban_chat_member", "delete_message", "delete_messages"]
+)
+
 
 def create_message_html(
     message: safe_html_str, user_profile: UserProfile, chat_settings: ChatSettings
 ) -> safe_html_str:
-    return substitute_html(
-        message,
-        {
-            "TAG": safe_html_str(chat_settings.introduction_tag),
-            "USER": _create_user_mention_html(
-                user_profile.user_chat_id.user_id,
-                first_name=user_profile.first_name(),
-                last_name=user_profile.last_name(),
-            ),
-        },
-    )
+    # Only render substitutions that are actually used by the template.
+    placeholders = html_template_placeholders(message)
+    substitutions: dict[str, safe_html_str] = {}
+    if "TAG" in placeholders:
+        substitutions["TAG"] = safe_html_str(chat_settings.introduction_tag)
+    if "USER" in placeholders:
+        substitutions["USER"] = _create_user_mention_html(
+            user_profile.user_chat_id.user_id,
+            first_name=user_profile.first_name(),
+            last_name=user_profile.last_name(),
+        )
+    return substitute_html(message, substitutions)
 
 
+@functools.lru_cache(maxsize=1024)
 def _create_user_mention_html(
     user_id: UserId, first_name: Optional[str], last_name: Optional[str]
 ) -> safe_html_str:
@@ -72,10 +98,8 @@ def _create_user_mention_html(
         name = f"{first_name} {last_name}"
     else:
         name = first_name
-    return safe_html_format(
-        safe_html_str('<a href="tg://user?id={user_id}">{name}</a>'),
-        {"user_id": escape_html(str(user_id)), "name": escape_html(name)},
-    )
+    # user_id is formatted as an integer and the name is escaped, so the result is safe.
+    return safe_html_str(f'<a href="tg://user?id={user_id:d}">{escape_html(name)}</a>')
 
 
 @contextlib.contextmanager
@@ -84,18 +108,38 @@ def open_user_profile(
     bot_storage: BotStorage,
     chat_settings: ChatSettings,
 ) -> Iterator[UserProfile]:
-    user_profile = bot_storage.get_profile(user_chat_id)
-    user_profile_params = UserProfileParams(
+    with save_user_profile_changes(
+        bot_storage.get_profile(user_chat_id), bot_storage, chat_settings
+    ) as user_profile:
+        yield user_profile
+
+
+def get_user_profile_params(chat_settings: ChatSettings) -> UserProfileParams:
+    return UserProfileParams(
         ichbin_waiting_time=chat_settings.ichbin_waiting_time,
         failed_kick_retry_time=chat_settings.failed_kick_retry_time,
     )
+
+
+@contextlib.contextmanager
+def save_user_profile_changes(
+    user_profile: UserProfile,
+    bot_storage: BotStorage,
+    chat_settings: ChatSettings,
+) -> Iterator[UserProfile]:
+    """Saves the already loaded user profile if it was modified."""
+    user_chat_id = user_profile.user_chat_id
+    user_profile_params = get_user_profile_params(chat_settings)
     original_json = user_profile.model_dump_json()
-    pretty_original_json = user_profile.model_dump_json(indent=2)
     previous_kick_at_timestamp = user_profile.get_kick_at_timestamp(user_profile_params)
     yield user_profile
     modified_json = user_profile.model_dump_json()
     if original_json == modified_json:
         return
+    # Most profiles are opened without changes, so the pretty-printed diff is only built here.
+    pretty_original_json = UserProfile.model_validate_json(
+        original_json
+    ).model_dump_json(indent=2)
     pretty_modified_json = user_profile.model_dump_json(indent=2)
     modified_kick_at_timestamp = user_profile.get_kick_at_timestamp(user_profile_params)
     diff = list(
@@ -115,7 +159,7 @@ def open_user_profile(
             previous_kick_at_timestamp,
             modified_kick_at_timestamp,
         )
-    bot_storage.save_profile(user_profile, user_profile_params)
+    bot_storage.save_profile(user_profile, modified_kick_at_timestamp)
 
 
 class MissingCapabilities(Exception):
@@ -132,6 +176,22 @@ class EventProcessor:
         # Global admin, @icebergler
         root_admin_user_id: UserId = UserId(290342629)
         chat_cmd_prefix: str = "/lancet_"
+        # How many times to retry a Bot API call that failed due to flood control or network errors.
+        bot_api_max_retries: int = 3
+        # Flood control waits longer than this are not retried, as they would stall the processing of all events.
+        bot_api_max_retry_after: timedelta = timedelta(seconds=5)
+        # Global limit on Bot API calls per second, Telegram allows ~30 messages per second.
+        bot_api_max_calls_per_second: float = 30.0
+        # How many users could be kicked concurrently during a periodic event.
+        max_concurrent_kicks: int = 25
+        # How many overdue users are picked up by a single periodic event, the rest wait for the next one.
+        max_kicks_per_periodic_event: int = 100
+        # Repeated joins of the same user within this window are ignored, e.g. on rapid rejoins.
+        duplicate_join_window: timedelta = timedelta(seconds=5)
+        # How often to run maintenance of the event queue storage.
+        event_queue_optimize_interval: timedelta = timedelta(hours=6)
+        # How often to truncate the WAL of the bot storage.
+        bot_storage_checkpoint_interval: timedelta = timedelta(minutes=30)
 
     def __init__(
         self,
@@ -146,8 +206,33 @@ class EventProcessor:
         self._telethon_client = telethon_client
         self._event_queue = event_queue
         self._bot_storage = bot_storage
-        self._last_periodic_event_timestamp = LocalUTCTimestamp(0.0)
+        self._bot_api_rate_limiter = RateLimiter(config.bot_api_max_calls_per_second)
+        self._periodic_event_interval_seconds = (
+            config.periodic_event_interval.total_seconds()
+        )
+        # When the next PeriodicEvent is due, advanced in fixed steps of periodic_event_interval.
+        self._next_periodic_event_timestamp = LocalUTCTimestamp(0.0)
+        self._duplicate_join_window_seconds = (
+            config.duplicate_join_window.total_seconds()
+        )
+        # Timestamp of the last processed join per user, see Config.duplicate_join_window.
+        self._recent_joins: dict[UserChatId, LocalUTCTimestamp] = {}
+        self._next_event_queue_optimize_timestamp = LocalUTCTimestamp(
+            time.time() + config.event_queue_optimize_interval.total_seconds()
+        )
+        self._next_bot_storage_checkpoint_timestamp = LocalUTCTimestamp(
+            time.time() + config.bot_storage_checkpoint_interval.total_seconds()
+        )
         self._stopped = False
+        self._event_handlers: dict[
+            type[BaseEvent], Callable[[Any], Awaitable[None]]
+        ] = {
+            BotApiNewTextMessage: self._on_bot_api_new_text_message,
+            BotApiChatMemberJoined: self._on_bot_api_new_chat_member,
+            BotApiChatMemberLeft: self._on_bot_api_chat_member_left,
+            PeriodicEvent: self._on_periodic_event,
+            StopEvent: self._on_stop_event,
+        }
 
     @contextlib.contextmanager
     def _open_user_profile(
@@ -168,17 +253,14 @@ class EventProcessor:
         while not self._stopped:
             event: BaseEvent | None = None
             try:
-                if (
-                    self._last_periodic_event_timestamp
-                    + self._config.periodic_event_interval.total_seconds()
-                    < time.time()
-                ):
-                    self._last_periodic_event_timestamp = LocalUTCTimestamp(time.time())
-                    event = PeriodicEvent(recv_timestamp=LocalUTCTimestamp(time.time()))
+                current_timestamp = LocalUTCTimestamp(time.time())
+                if current_timestamp >= self._next_periodic_event_timestamp:
+                    self._schedule_next_periodic_event(current_timestamp)
+                    event = PeriodicEvent(recv_timestamp=current_timestamp)
                     await self._handle_event(event)
                 else:
                     async with self._event_queue.get_event_for_processing(
-                        timeout=1.0
+                        timeout=self._next_periodic_event_timestamp - current_timestamp
                     ) as event:
                         if event is None:
                             continue
@@ -199,20 +281,68 @@ class EventProcessor:
                     )
         logging.info("Exiting the EventProcessor.run() loop")
 
+    def _schedule_next_periodic_event(
+        self, current_timestamp: LocalUTCTimestamp
+    ) -> None:
+        self._next_periodic_event_timestamp = LocalUTCTimestamp(
+            self._next_periodic_event_timestamp + self._periodic_event_interval_seconds
+        )
+        if self._next_periodic_event_timestamp <= current_timestamp:
+            # We are late by more than one interval (e.g. a long kick sweep), coalesce the missed ticks.
+            self._next_periodic_event_timestamp = LocalUTCTimestamp(
+                current_timestamp + self._periodic_event_interval_seconds
+            )
+
     async def _handle_event(self, event: BaseEvent) -> None:
-        if isinstance(event, BotApiNewTextMessage):
-            await self._on_bot_api_new_text_message(event)
-        elif isinstance(event, BotApiChatMemberJoined):
-            await self._on_bot_api_new_chat_member(event)
-        elif isinstance(event, BotApiChatMemberLeft):
-            await self._on_bot_api_chat_member_left(event)
-        elif isinstance(event, PeriodicEvent):
-            await self._on_periodic_event(event)
-        elif isinstance(event, StopEvent):
-            logging.info("Handled stop event.")
-            self._stopped = True
-        else:
+        handler = self._event_handlers.get(type(event))
+        if handler is None:
             logging.critical("BUG: Unknown event: %s, skipping.", event)
+            return
+        await handler(event)
+
+    async def _on_stop_event(self, event: StopEvent) -> None:
+        logging.info("Handled stop event.")
+        self._stopped = True
+        self._bot_storage.optimize()
+
+    async def _send_with_retry(
+        self, fn: Callable[_P, Awaitable[_T]], *args: _P.args, **kwargs: _P.kwargs
+    ) -> _T:
+        """Calls the Bot API method, retrying it on short flood control (HTTP 429) waits and, for idempotent methods, network errors."""
+        is_idempotent = getattr(fn, "__name__", None) in _IDEMPOTENT_BOT_API_METHODS
+        attempt = 0
+        while True:
+            await self._bot_api_rate_limiter.acquire()
+            try:
+                return await fn(*args, **kwargs)
+            except aiogram.exceptions.TelegramRetryAfter as exc:
+                if attempt >= self._config.bot_api_max_retries:
+                    raise
+                if (
+                    exc.retry_after
+                    > self._config.bot_api_max_retry_after.total_seconds()
+                ):
+                    logging.error(
+                        "Flood control exceeded, not waiting for %s seconds: %s",
+                        exc.retry_after,
+                        exc,
+                    )
+                    raise
+                logging.warning(
+                    "Flood control exceeded, retrying in %s seconds: %s",
+                    exc.retry_after,
+                    exc,
+                )
+                await asyncio.sleep(exc.retry_after + 0.1)
+            except aiogram.exceptions.TelegramNetworkError as exc:
+                if not is_idempotent or attempt >= self._config.bot_api_max_retries:
+                    raise
+                backoff = 2.0**attempt
+                logging.warning(
+                    "Network error, retrying in %s seconds: %s", backoff, exc
+                )
+                await asyncio.sleep(backoff)
+            attempt += 1
 
     def _get_capabilities(
         self, user_id: UserId, chat_id: ChatId
@@ -244,7 +374,9 @@ class EventProcessor:
                 logging.info(
                     "Sending message %r to chat %r", message, destination_chat_id
                 )
-                await self._bot.send_message(chat_id=destination_chat_id, text=message)
+                await self._send_with_retry(
+                    self._bot.send_message, chat_id=destination_chat_id, text=message
+                )
                 response_message = "Message sent!"
             elif command == self._config.chat_cmd_prefix + "chats":
                 chats = self._bot_storage.get_chats()
@@ -407,6 +539,8 @@ class EventProcessor:
             traceback_message = traceback.format_exc()
         if response_message is None:
             response_message = "Command executed successfully."
+        # Traceback message and response are independent, so they are sent concurrently.
+        replies: List[Awaitable[None]] = []
         if traceback_message is not None:
             if not self._get_capabilities(
                 cmd_user_id, chat_id=ChatId(cmd_user_id)
@@ -421,20 +555,35 @@ class EventProcessor:
                     response_message += (
                         "\n\n" + "Traceback was sent to you in a private message."
                     )
-                    try:
-                        await self._bot.send_message(
-                            chat_id=event.user_chat_id.user_id,
-                            text=html.escape(traceback_message),
-                            parse_mode=ParseMode.HTML,
-                        )
-                    except Exception:
-                        logging.error(
-                            "Failed to send traceback to user %r",
-                            event.user_chat_id.user_id,
-                            exc_info=True,
+                    replies.append(
+                        self._send_traceback(
+                            event.user_chat_id.user_id, traceback_message
                         )
+                    )
+        replies.append(self._send_command_response(event, response_message))
+        await asyncio.gather(*replies)
+
+    async def _send_traceback(self, user_id: UserId, traceback_message: str) -> None:
         try:
-            await self._bot.send_message(
+            await self._send_with_retry(
+                self._bot.send_message,
+                chat_id=user_id,
+                text=html.escape(traceback_message),
+                parse_mode=ParseMode.HTML,
+            )
+        except Exception:
+            logging.error(
+                "Failed to send traceback to user %r",
+                user_id,
+                exc_info=True,
+            )
+
+    async def _send_command_response(
+        self, event: BotApiNewTextMessage, response_message: str | safe_html_str
+    ) -> None:
+        try:
+            await self._send_with_retry(
+                self._bot.send_message,
                 chat_id=event.user_chat_id.chat_id,
                 text=response_message
                 if isinstance(response_message, safe_html_str)
@@ -459,11 +608,16 @@ class EventProcessor:
             logging.info("Got a command-like message from admin: %r", event)
             await self._on_admin_message(event)
             return
+        # Hashtags are case-insensitive in Telegram, so #IchBin counts too.
+        has_introduction_tag = (
+            chat_settings.introduction_tag.casefold() in event.text.casefold()
+        )
         # We process #ichbin messages even if the bot is disabled in the chat.
         # TODO: Update this behavior if it's not desired.
         with self._open_user_profile(event.user_chat_id, chat_settings) as user_profile:
+            # Keep the name up to date even if the message is not an introduction.
             user_profile.basic_user_info = event.basic_user_info
-            if chat_settings.introduction_tag not in event.text:
+            if not has_introduction_tag:
                 return
             if not user_profile.is_waiting_for_ichbin_message():
                 logging.info(
@@ -486,6 +640,17 @@ class EventProcessor:
         return user_id == (await self._bot.me()).id
 
     async def _on_bot_api_new_chat_member(self, event: BotApiChatMemberJoined) -> None:
+        last_join_timestamp = self._recent_joins.get(event.user_chat_id)
+        # A retry of the same event after a failed attempt has the same recv_timestamp and is not a duplicate.
+        if (
+            last_join_timestamp is not None
+            and last_join_timestamp != event.recv_timestamp
+            and event.recv_timestamp - last_join_timestamp
+            < self._duplicate_join_window_seconds
+        ):
+            logging.info("Ignoring duplicate join of user %r", event.user_chat_id)
+            return
+        self._recent_joins[event.user_chat_id] = event.recv_timestamp
         self._bot_storage.add_chat(event.user_chat_id.chat_id, event.chat_info)
         chat_settings = self._bot_storage.get_chat_settings(event.user_chat_id.chat_id)
         if not chat_settings.ichbin_enabled:
@@ -525,14 +690,8 @@ class EventProcessor:
                 )
                 user_profile.ichbin_request_timestamp = bot_message.sent_timestamp
                 return
-            chat_settings = self._bot_storage.get_chat_settings(
-                event.user_chat_id.chat_id
-            )
             kick_at_timestamp = user_profile.get_kick_at_timestamp(
-                UserProfileParams(
-                    ichbin_waiting_time=chat_settings.ichbin_waiting_time,
-                    failed_kick_retry_time=chat_settings.failed_kick_retry_time,
-                )
+                get_user_profile_params(chat_settings)
             )
             if kick_at_timestamp is None:
                 logging.warning(
@@ -540,22 +699,19 @@ class EventProcessor:
                 )
                 return
             time_left = kick_at_timestamp - event.recv_timestamp
+            extra_waiting_time = (
+                chat_settings.extra_ichbin_waiting_time_after_rejoining.total_seconds()
+            )
             logging.info(
                 "Time left for user %s to write ichbin: %s (boundary: %s)",
                 user_profile.user_chat_id,
                 time_left,
-                chat_settings.extra_ichbin_waiting_time_after_rejoining.total_seconds(),
+                extra_waiting_time,
             )
-            if (
-                time_left
-                > chat_settings.extra_ichbin_waiting_time_after_rejoining.total_seconds()
-            ):
+            if time_left > extra_waiting_time:
                 # No need yet to warn the user that he will be kicked soon.
                 return
-            user_profile.add_extra_grace_time(
-                chat_settings.extra_ichbin_waiting_time_after_rejoining.total_seconds()
-                - time_left
-            )
+            user_profile.add_extra_grace_time(extra_waiting_time - time_left)
             await self._send_bot_reply(
                 user_profile,
                 BotReplyType.NOT_MUCH_TIME_LEFT_TO_WRITE_ICHBIN,
@@ -569,7 +725,8 @@ class EventProcessor:
         chat_settings: ChatSettings,
     ) -> BotApiMessage:
         if chat_settings.dark_launch_sink_chat_id is None:
-            sent_message = await self._bot.send_message(
+            sent_message = await self._send_with_retry(
+                self._bot.send_message,
                 user_profile.user_chat_id.chat_id,
                 create_message_html(
                     chat_settings.bot_replies.get_reply(bot_reply_type).template,
@@ -583,7 +740,8 @@ class EventProcessor:
                 "Redirecting message to dark launch chat %r",
                 chat_settings.dark_launch_sink_chat_id,
             )
-            sent_message = await self._bot.send_message(
+            sent_message = await self._send_with_retry(
+                self._bot.send_message,
                 chat_settings.dark_launch_sink_chat_id,
                 create_message_html(
                     chat_settings.bot_replies.get_reply(bot_reply_type).template,
@@ -605,6 +763,8 @@ class EventProcessor:
 
     async def _on_bot_api_chat_member_left(self, event: BotApiChatMemberLeft) -> None:
         logging.info("User %s left the chat", event.user_chat_id)
+        # The user could rejoin right away, that join is not a duplicate.
+        self._recent_joins.pop(event.user_chat_id, None)
         if await self._is_me(event.user_chat_id.user_id):
             logging.info("I left the chat %r", event.user_chat_id.chat_id)
             self._bot_storage.remove_chat(event.user_chat_id.chat_id)
@@ -613,127 +773,195 @@ class EventProcessor:
             user_profile.on_left(left_timestamp=event.recv_timestamp)
 
     async def _on_periodic_event(self, event: PeriodicEvent) -> None:
-        users_to_kick = self._bot_storage.get_users_to_kick(event.recv_timestamp)
-        if users_to_kick:
-            logging.info("Found users to kick: %r", users_to_kick)
-        for user_chat_id in users_to_kick:
-            try:
-                await self._verify_and_kick_user(user_chat_id, event.recv_timestamp)
-            except Exception:
-                logging.error(
-                    "Error while kicking user %r", user_chat_id, exc_info=True
+        self._recent_joins = {
+            user_chat_id: join_timestamp
+            for user_chat_id, join_timestamp in self._recent_joins.items()
+            if event.recv_timestamp - join_timestamp
+            < self._duplicate_join_window_seconds
+        }
+        if event.recv_timestamp >= self._next_event_queue_optimize_timestamp:
+            self._next_event_queue_optimize_timestamp = LocalUTCTimestamp(
+                event.recv_timestamp
+                + self._config.event_queue_optimize_interval.total_seconds()
+            )
+            await self._event_queue.optimize()
+        if event.recv_timestamp >= self._next_bot_storage_checkpoint_timestamp:
+            self._next_bot_storage_checkpoint_timestamp = LocalUTCTimestamp(
+                event.recv_timestamp
+                + self._config.bot_storage_checkpoint_interval.total_seconds()
+            )
+            # The checkpoint syncs the database file, which should not block the event loop.
+            # BotStorage connections come from a thread-safe pool, and the profile cache is not touched.
+            await asyncio.to_thread(self._bot_storage.checkpoint)
+        profiles_to_kick = self._bot_storage.get_profiles_to_kick(
+            event.recv_timestamp, limit=self._config.max_kicks_per_periodic_event
+        )
+        if profiles_to_kick:
+            logging.info(
+                "Found users to kick: %r",
+                [user_profile.user_chat_id for user_profile in profiles_to_kick],
+            )
+        kick_semaphore = asyncio.Semaphore(self._config.max_concurrent_kicks)
+        await asyncio.gather(
+            *(
+                self._guarded_verify_and_kick_user(
+                    kick_semaphore, user_profile, event.recv_timestamp
                 )
-                continue
+                for user_profile in profiles_to_kick
+            )
+        )
         welcome_messages_per_chat = defaultdict(list)
         messages_per_user: DefaultDict[UserChatId, List[BotApiMessage]] = defaultdict(
             list
         )
-        for bot_api_message in self._bot_storage.get_bot_messages():
+        bot_api_messages = self._bot_storage.get_bot_messages()
+        # Fetched once per chat instead of once per message.
+        chat_settings_per_chat = {
+            chat_id: self._bot_storage.get_chat_settings(chat_id)
+            for chat_id in {msg.user_chat_id.chat_id for msg in bot_api_messages}
+        }
+        for bot_api_message in bot_api_messages:
             if bot_api_message.reply_type == BotReplyType.WELCOME:
                 welcome_messages_per_chat[bot_api_message.user_chat_id.chat_id].append(
                     bot_api_message
                 )
             messages_per_user[bot_api_message.user_chat_id].append(bot_api_message)
-        for chat_id, welcome_messages in welcome_messages_per_chat.items():
-            chat_settings = self._bot_storage.get_chat_settings(chat_id)
-            await self._delete_all_but_last_message(
-                welcome_messages,
-                event.recv_timestamp,
-                delete_welcome_messages=True,
-                chat_settings=chat_settings,
+        messages_to_delete: List[BotApiMessage] = []
+        for welcome_messages in welcome_messages_per_chat.values():
+            messages_to_delete.extend(
+                self._all_but_last_message(
+                    welcome_messages, delete_welcome_messages=True
+                )
             )
             # TODO: "welcome" messages should not have TTL setting.
         for user, messages in messages_per_user.items():
-            chat_settings = self._bot_storage.get_chat_settings(user.chat_id)
-            messages = await self._delete_all_but_last_message(
-                messages,
-                event.recv_timestamp,
-                delete_welcome_messages=False,
-                chat_settings=chat_settings,
+            messages = list(messages)
+            messages.sort(key=lambda msg: msg.sent_timestamp)
+            messages_to_delete.extend(
+                self._all_but_last_message(messages, delete_welcome_messages=False)
             )
-            await self._delete_expired_messages(
-                messages, event.recv_timestamp, delete_welcome_messages=False
+            messages_to_delete.extend(
+                self._expired_messages(
+                    messages[-1:],
+                    event.recv_timestamp,
+                    delete_welcome_messages=False,
+                    chat_settings_per_chat=chat_settings_per_chat,
+                )
             )
+        await self._delete_messages(
+            messages_to_delete, event.recv_timestamp, chat_settings_per_chat
+        )
 
-    async def _delete_all_but_last_message(
+    def _all_but_last_message(
         self,
         messages: Iterable[BotApiMessage],
-        current_timestamp: LocalUTCTimestamp,
         delete_welcome_messages: bool,
-        chat_settings: ChatSettings,
     ) -> List[BotApiMessage]:
         messages = list(messages)
         messages.sort(key=lambda msg: msg.sent_timestamp)
-        for msg in messages[:-1]:
-            # Even if we don't delete welcome messages, we still make them take space in the list, so that earlier messages would get removed.
-            if msg.reply_type == BotReplyType.WELCOME and not delete_welcome_messages:
-                continue
-            await self._delete_message(msg, current_timestamp, chat_settings)
-        return messages[-1:]
+        # Even if we don't delete welcome messages, we still make them take space in the list, so that earlier messages would get removed.
+        return [
+            msg
+            for msg in messages[:-1]
+            if msg.reply_type != BotReplyType.WELCOME or delete_welcome_messages
+        ]
 
-    async def _delete_expired_messages(
+    def _expired_messages(
         self,
         messages: Iterable[BotApiMessage],
         current_timestamp: LocalUTCTimestamp,
         delete_welcome_messages: bool,
-    ) -> None:
+        chat_settings_per_chat: dict[ChatId, ChatSettings],
+    ) -> List[BotApiMessage]:
+        expired_messages = []
         for msg in messages:
             if msg.reply_type == BotReplyType.WELCOME and not delete_welcome_messages:
                 continue
-            chat_settings = self._bot_storage.get_chat_settings(
-                msg.user_chat_id.chat_id
-            )
+            chat_settings = chat_settings_per_chat[msg.user_chat_id.chat_id]
             msg_ttl = chat_settings.bot_replies.get_reply(msg.reply_type).ttl
             if current_timestamp > msg.sent_timestamp + msg_ttl.total_seconds():
-                await self._delete_message(msg, current_timestamp, chat_settings)
+                expired_messages.append(msg)
+        return expired_messages
 
-    async def _delete_message(
+    async def _delete_messages(
         self,
-        message: BotApiMessage,
+        messages: List[BotApiMessage],
+        current_timestamp: LocalUTCTimestamp,
+        chat_settings_per_chat: dict[ChatId, ChatSettings],
+    ) -> None:
+        """Deletes messages in bulk, one Bot API call per chat and up to 100 messages."""
+        messages_per_target_chat: DefaultDict[ChatId, List[BotApiMessage]] = (
+            defaultdict(list)
+        )
+        for message in messages:
+            chat_settings = chat_settings_per_chat[message.user_chat_id.chat_id]
+            if chat_settings.dark_launch_sink_chat_id is None:
+                target_chat_id = message.user_chat_id.chat_id
+            else:
+                target_chat_id = chat_settings.dark_launch_sink_chat_id
+            messages_per_target_chat[target_chat_id].append(message)
+        for target_chat_id, chat_messages in messages_per_target_chat.items():
+            for i in range(0, len(chat_messages), _MAX_MESSAGES_PER_DELETE):
+                await self._delete_message_batch(
+                    target_chat_id,
+                    chat_messages[i : i + _MAX_MESSAGES_PER_DELETE],
+                    current_timestamp,
+                )
+
+    async def _delete_message_batch(
+        self,
+        target_chat_id: ChatId,
+        messages: List[BotApiMessage],
         current_timestamp: LocalUTCTimestamp,
-        chat_settings: ChatSettings,
     ) -> None:
         try:
             try:
-                if chat_settings.dark_launch_sink_chat_id is None:
-                    logging.info("Trying to delete message %r", message)
-                    await self._bot.delete_message(
-                        chat_id=message.user_chat_id.chat_id,
-                        message_id=message.message_id,
-                    )
-                else:
-                    logging.info(
-                        "Deleting message %r in dark launch chat %r",
-                        message,
-                        chat_settings.dark_launch_sink_chat_id,
-                    )
-                    await self._bot.delete_message(
-                        chat_id=chat_settings.dark_launch_sink_chat_id,
-                        message_id=message.message_id,
-                    )
+                logging.info(
+                    "Trying to delete messages %r in chat %r", messages, target_chat_id
+                )
+                await self._send_with_retry(
+                    self._bot.delete_messages,
+                    chat_id=target_chat_id,
+                    message_ids=[message.message_id for message in messages],
+                )
             except aiogram.exceptions.TelegramBadRequest:
                 # TODO: Add support for deleting messages that are older than 48 hours.
                 logging.error(
-                    "Failed to delete message %r, due to possibly unretriable error",
-                    message,
+                    "Failed to delete messages %r, due to possibly unretriable error",
+                    messages,
                     exc_info=True,
                 )
-            self._bot_storage.mark_bot_message_as_deleted(
-                message.user_chat_id,
-                message.message_id,
-                delete_timestamp=current_timestamp,
+            self._bot_storage.mark_bot_messages_as_deleted(
+                messages, delete_timestamp=current_timestamp
             )
         except Exception:
-            logging.error("Failed to delete message %r", message, exc_info=True)
+            logging.error("Failed to delete messages %r", messages, exc_info=True)
+
+    async def _guarded_verify_and_kick_user(
+        self,
+        semaphore: asyncio.Semaphore,
+        user_profile: UserProfile,
+        current_timestamp: LocalUTCTimestamp,
+    ) -> None:
+        async with semaphore:
+            try:
+                await self._verify_and_kick_user(user_profile, current_timestamp)
+            except Exception:
+                logging.error(
+                    "Error while kicking user %r",
+                    user_profile.user_chat_id,
+                    exc_info=True,
+                )
 
     async def _verify_and_kick_user(
         self,
-        user_chat_id: UserChatId,
+        user_profile: UserProfile,
         current_timestamp: LocalUTCTimestamp,
     ) -> None:
+        user_chat_id = user_profile.user_chat_id
         logging.info("Attempting to kick user %r", user_chat_id)
         chat_settings = self._bot_storage.get_chat_settings(user_chat_id.chat_id)
-        with self._open_user_profile(user_chat_id, chat_settings) as user_profile:
+        with save_user_profile_changes(user_profile, self._bot_storage, chat_settings):
             if not chat_settings.ichbin_enabled:
                 logging.info(
                     "Chat %s has #ichbin disabled, user %r is forgiven.",
@@ -743,29 +971,31 @@ class EventProcessor:
                 user_profile.forgiven_timestamp = current_timestamp
                 return
             kick_at_timestamp = user_profile.get_kick_at_timestamp(
-                UserProfileParams(
-                    ichbin_waiting_time=chat_settings.ichbin_waiting_time,
-                    failed_kick_retry_time=chat_settings.failed_kick_retry_time,
-                )
+                get_user_profile_params(chat_settings)
             )
-            if kick_at_timestamp is None:
-                logging.warning(
-                    "User %r kick_at_timestamp is None, skipping",
-                    user_chat_id,
-                )
-                return
-            if kick_at_timestamp > current_timestamp:
-                logging.warning(
-                    "User %r is still in grace period, skipping: %s > %s",
-                    user_chat_id,
-                    kick_at_timestamp,
-                    current_timestamp,
-                )
+            if kick_at_timestamp is None or kick_at_timestamp > current_timestamp:
+                # The stored kick_at_timestamp is stale, e.g. the chat settings have changed.
+                # The profile itself is not modified, so it has to be saved explicitly, otherwise
+                # the user would be picked up again by every periodic event, taking the place of others.
+                if kick_at_timestamp is None:
+                    logging.warning(
+                        "User %r kick_at_timestamp is None, skipping",
+                        user_chat_id,
+                    )
+                else:
+                    logging.warning(
+                        "User %r is still in grace period, skipping: %s > %s",
+                        user_chat_id,
+                        kick_at_timestamp,
+                        current_timestamp,
+                    )
+                self._bot_storage.save_profile(user_profile, kick_at_timestamp)
                 return
             if chat_settings.dark_launch_sink_chat_id is None:
                 logging.info("Kicking user %r", user_chat_id)
                 try:
-                    await self._bot.ban_chat_member(
+                    await self._send_with_retry(
+                        self._bot.ban_chat_member,
                         chat_id=user_chat_id.chat_id,
                         user_id=user_chat_id.user_id,
                         until_date=chat_settings.ban_duration,
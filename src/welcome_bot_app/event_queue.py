@@ -1,9 +1,11 @@
 from abc import ABC, abstractmethod
 import sqlite3
+import concurrent.futures
 import contextlib
+from dataclasses import dataclass
 from pydantic import BaseModel
 from enum import Enum
-from typing import AsyncIterator, List, NewType, Any, Generator
+from typing import AsyncIterator, Callable, List, NewType, Any, TypeVar
 import logging
 import time
 import asyncio
@@ -12,6 +14,8 @@ from welcome_bot_app.model.events import BaseEvent, BaseEventSubclass
 
 EventId = NewType("EventId", int)
 
+_T = TypeVar("_T")
+
 
 class EventStateEnum(str, Enum):
     # Initially the task is in NEW state.
@@ -24,6 +28,37 @@ class EventStateEnum(str, Enum):
     ERROR = "ERROR"
 
 
+# NOTE: The NEW state is inlined into the statements instead of being a parameter, so that SQLite could use the partial
+# index idx_NewEventsByRecvTimestamp for them.
+_SQL_INSERT_EVENT = f"""
+    INSERT INTO events (recv_timestamp, event_type, event_json, state, state_update_timestamp, attempts_json)
+    VALUES (?, ?, ?, '{EventStateEnum.NEW.value}', ?, ?)"""
+_SQL_COUNT_NEW_EVENTS = f"""
+    SELECT COUNT(*) FROM events WHERE state = '{EventStateEnum.NEW.value}'"""
+_SQL_POP_NEXT_EVENT = f"""
+    UPDATE events SET state = '{EventStateEnum.IN_PROGRESS.value}', state_update_timestamp = ?
+    WHERE event_id = (
+        SELECT event_id FROM events WHERE state = '{EventStateEnum.NEW.value}' ORDER BY recv_timestamp ASC LIMIT 1
+    )
+    RETURNING event_id, event_json, state_update_timestamp"""
+# Attempts are appended by SQLite, so that the attempts JSON doesn't have to be decoded and encoded again.
+_SQL_RELEASE_SUCCEEDED_EVENT = f"""
+    UPDATE events
+    SET state = '{EventStateEnum.DONE.value}', state_update_timestamp = ?,
+        attempts_json = json_insert(attempts_json, '$.attempts[#]', json(?))
+    WHERE event_id = ? AND state = '{EventStateEnum.IN_PROGRESS.value}'"""
+# The event is retried until it has max_attempts attempts, including the current one.
+_SQL_RELEASE_FAILED_EVENT = f"""
+    UPDATE events
+    SET state = CASE
+            WHEN json_array_length(attempts_json, '$.attempts') + 1 >= ? THEN '{EventStateEnum.ERROR.value}'
+            ELSE '{EventStateEnum.NEW.value}'
+        END,
+        state_update_timestamp = ?,
+        attempts_json = json_insert(attempts_json, '$.attempts[#]', json(?))
+    WHERE event_id = ? AND state = '{EventStateEnum.IN_PROGRESS.value}'"""
+
+
 class EventProcessingAttempt(BaseModel):
     start_timestamp: LocalUTCTimestamp
     finish_timestamp: LocalUTCTimestamp | None
@@ -34,22 +69,14 @@ class EventProcessingAttempts(BaseModel):
     attempts: List[EventProcessingAttempt]
 
 
-class EventData(BaseModel):
-    recv_timestamp: LocalUTCTimestamp
-    event_type: str
-    event_json: str
-
-
-class EventExecutionState(BaseModel):
-    state: EventStateEnum
-    state_update_timestamp: LocalUTCTimestamp
-    attempts: EventProcessingAttempts
-
+@dataclass(slots=True)
+class EventRow:
+    """Columns of the acquired event which are needed for its processing."""
 
-class EventRow(BaseModel):
     event_id: EventId
-    event_data: EventData
-    execution_state: EventExecutionState
+    event_json: str
+    # When the event was acquired.
+    state_update_timestamp: LocalUTCTimestamp
 
 
 class BaseEventQueue(ABC):
@@ -66,18 +93,23 @@ class BaseEventQueue(ABC):
     async def put_events(self, event_datas: List[BaseEvent]) -> None:
         pass
 
+    @abstractmethod
+    async def optimize(self) -> None:
+        """Performs periodic maintenance of the underlying storage."""
+        pass
+
 
 class SqliteEventQueue(BaseEventQueue):
     class Options(BaseModel):
         # Check Events table every `get_new_event_timeout` irregardless of whether we are notified about new events.
-        get_new_event_timeout: float = 1.0
+        # In-process producers always notify consumers, so this is only a sanity check for events inserted by other processes.
+        get_new_event_timeout: float = 60.0
         # Maximum number of retries for processing the event. After that the event is marked as ERROR.
         max_attempts: int = 1
-
-    class EventAcquireFailure(Exception):
-        """Raised when we failed to acquire the event for processing."""
-
-        pass
+        # Log a warning when the number of NEW events in the queue exceeds this threshold.
+        backlog_warning_threshold: int = 1000
+        # Counting NEW events takes time proportional to the backlog, so it's done at most once per this many seconds.
+        backlog_check_interval: float = 10.0
 
     class EventReleaseFailure(Exception):
         """Raised when we failed to release the event after processing."""
@@ -88,17 +120,35 @@ class SqliteEventQueue(BaseEventQueue):
         self.db_path = db_path
         self._options = options
         # Set isolation_level to None, so that we could roll our own transactions.
-        self._conn = sqlite3.connect(db_path, isolation_level=None)
+        # All queries after initialization run on self._db_executor, so the connection is used by one thread at a time.
+        self._conn = sqlite3.connect(
+            db_path, isolation_level=None, check_same_thread=False
+        )
         self._create_table()
+        # Single worker thread, so that blocking SQLite calls don't stall the event loop and are executed in order.
+        self._db_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="SqliteEventQueue"
+        )
 
-        # Condition variable to notify about new events.
-        self._new_events_available_cond = asyncio.Condition()
-        # Flag to indicate that new events are available. Guarded by self._new_events_available_cond
-        self._new_events_available = False
+        # Set when new events are available.
+        self._new_events_available = asyncio.Event()
+        # Whether the backlog is above options.backlog_warning_threshold, so that we warn only once per overflow.
+        self._backlog_overflow = False
+        # time.monotonic() of the next _check_backlog() that actually counts the events.
+        self._next_backlog_check_time = 0.0
 
     def _create_table(self) -> None:
         self._conn.execute("PRAGMA strict=ON")
         self._conn.execute("PRAGMA journal_mode=wal")
+        # With WAL, synchronous=NORMAL could lose the last transactions on power loss, but never corrupts the database.
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA temp_store=MEMORY")
+        # Negative value is in KiB.
+        self._conn.execute("PRAGMA cache_size=-20000")
+        self._conn.execute("PRAGMA mmap_size=268435456")
+        if sqlite3.sqlite_version_info < (3, 46, 0):
+            # Bound the work done by PRAGMA optimize, newer SQLite versions do this automatically.
+            self._conn.execute("PRAGMA analysis_limit=1000")
         self._conn.execute("""CREATE TABLE IF NOT EXISTS Events (
                           -- Unique event id.
                           event_id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
@@ -114,136 +164,110 @@ class SqliteEventQueue(BaseEventQueue):
                           -- JSON
                           attempts_json TEXT NOT NULL
                        )""")
+        # idx_NewEvents had a condition that never matched any rows, see idx_NewEventsByRecvTimestamp instead.
+        self._conn.execute("DROP INDEX IF EXISTS idx_NewEvents")
         self._conn.execute(
-            f'''CREATE INDEX IF NOT EXISTS idx_NewEvents ON Events (state, recv_timestamp ASC) WHERE state = "{EventStateEnum.NEW}"'''
+            f"""CREATE INDEX IF NOT EXISTS idx_NewEventsByRecvTimestamp ON Events (recv_timestamp ASC) WHERE state = '{EventStateEnum.NEW.value}'"""
         )
+        self._conn.execute("PRAGMA optimize")
 
-    def _parse_event_row(self, row: Any) -> EventRow:
-        return EventRow(
-            event_id=row[0],
-            event_data=EventData(
-                recv_timestamp=row[1], event_type=row[2], event_json=row[3]
-            ),
-            execution_state=EventExecutionState(
-                state=row[4],
-                state_update_timestamp=row[5],
-                attempts=EventProcessingAttempts.model_validate_json(row[6]),
-            ),
+    def close(self) -> None:
+        """Waits for pending queries and closes the database."""
+        self._db_executor.shutdown(wait=True)
+        self._conn.execute("PRAGMA optimize")
+        self._conn.close()
+
+    async def optimize(self) -> None:
+        """Refreshes query planner statistics, if needed."""
+        await self._run_in_db_thread(self._conn.execute, "PRAGMA optimize")
+
+    async def _run_in_db_thread(self, fn: Callable[..., _T], *args: Any) -> _T:
+        return await asyncio.get_running_loop().run_in_executor(
+            self._db_executor, fn, *args
         )
 
-    def _get_new_event_ids(self, limit: int) -> List[EventId]:
-        cursor = self._conn.cursor()
-        cursor.execute(
-            "SELECT event_id FROM events WHERE state = ? ORDER BY recv_timestamp ASC LIMIT ?",
-            (EventStateEnum.NEW, limit),
+    def _parse_event_row(self, row: Any) -> EventRow:
+        return EventRow(
+            event_id=row[0], event_json=row[1], state_update_timestamp=row[2]
         )
-        rows = cursor.fetchall()
-        # XXX: Breakage point here on broken attempts_json.
-        return [row[0] for row in rows]
 
-    def _acquire_event(self, event_id: EventId) -> EventRow:
-        """Update the state of the event to IN_PROGRESS ONLY if it is in NEW state.
+    def _count_new_events(self) -> int:
+        return int(self._conn.execute(_SQL_COUNT_NEW_EVENTS).fetchone()[0])
+
+    def _check_backlog(self) -> None:
+        """Warns when producers outpace the event processor."""
+        now = time.monotonic()
+        if now < self._next_backlog_check_time:
+            return
+        self._next_backlog_check_time = now + self._options.backlog_check_interval
+        backlog_size = self._count_new_events()
+        if backlog_size > self._options.backlog_warning_threshold:
+            if not self._backlog_overflow:
+                logging.warning(
+                    "Event queue backlog is too large: %d new events", backlog_size
+                )
+            self._backlog_overflow = True
+        elif self._backlog_overflow:
+            logging.info("Event queue backlog is back to %d new events", backlog_size)
+            self._backlog_overflow = False
+
+    def _pop_next_event(self) -> EventRow | None:
+        """Update the state of the oldest NEW event to IN_PROGRESS and return it.
+
+        Returns None if there are no NEW events."""
+        # A single statement is atomic, so no explicit transaction is needed.
+        row = self._conn.execute(
+            _SQL_POP_NEXT_EVENT, (LocalUTCTimestamp(time.time()),)
+        ).fetchone()
+        if row is None:
+            return None
+        return self._parse_event_row(row)
 
-        Returns True, if the event was acquired successfully, False otherwise."""
-        cursor = self._conn.cursor()
-        cursor.execute("BEGIN IMMEDIATE TRANSACTION")
-        try:
-            update_timestamp = LocalUTCTimestamp(time.time())
-            cursor.execute(
-                "UPDATE events SET state = ?, state_update_timestamp = ? WHERE event_id = ? AND state = ?",
+    def _release_event(
+        self, event_id: EventId, attempt: EventProcessingAttempt
+    ) -> bool:
+        """Update the state of the event to DONE, NEW or ERROR from IN_PROGRESS, depending on the event processing result."""
+        # The attempt's finish is also the moment the event changes its state.
+        update_timestamp = attempt.finish_timestamp
+        if attempt.error is None:
+            cursor = self._conn.execute(
+                _SQL_RELEASE_SUCCEEDED_EVENT,
+                (update_timestamp, attempt.model_dump_json(), event_id),
+            )
+        else:
+            cursor = self._conn.execute(
+                _SQL_RELEASE_FAILED_EVENT,
                 (
-                    EventStateEnum.IN_PROGRESS,
+                    self._options.max_attempts,
                     update_timestamp,
+                    attempt.model_dump_json(),
                     event_id,
-                    EventStateEnum.NEW,
                 ),
             )
-            if cursor.rowcount == 0:
-                raise SqliteEventQueue.EventAcquireFailure(
-                    f"Failed to acquire the event {event_id!r} for processing"
-                )
-            cursor.execute(
-                "SELECT event_id, recv_timestamp, event_type, event_json, state, state_update_timestamp, attempts_json FROM events WHERE event_id = ?",
-                (event_id,),
-            )
-            row = cursor.fetchone()
-            if row is None:
-                raise SqliteEventQueue.EventAcquireFailure(
-                    f"Event not found after acquiring: {event_id!r}"
-                )
-            event_row = self._parse_event_row(row)
-            if event_row.execution_state.state != EventStateEnum.IN_PROGRESS:
-                raise SqliteEventQueue.EventAcquireFailure(
-                    f"Event {event_id!r} state is not IN_PROGRESS after acquiring: {event_row.execution_state.state}"
-                )
-            if event_row.execution_state.state_update_timestamp != update_timestamp:
-                raise SqliteEventQueue.EventAcquireFailure(
-                    f"Event {event_id!r} state_update_timestamp mismatch after acquiring: {event_row.execution_state.state_update_timestamp} != {update_timestamp}"
-                )
-        except Exception:
-            cursor.execute("ROLLBACK")
-            raise
-        else:
-            cursor.execute("COMMIT")
-            return event_row
-
-    def _release_event(
-        self, event_id: EventId, event_execution_state: EventExecutionState
-    ) -> bool:
-        """Update the state of the event to DONE or ERROR from IN_PROGRESS, depending on the event processing result."""
-        update_timestamp = LocalUTCTimestamp(time.time())
-        cursor = self._conn.cursor()
-        cursor.execute(
-            """
-            UPDATE events
-            SET state = ?, state_update_timestamp = ?, attempts_json = ?
-            WHERE event_id = ? AND state = ?""",
-            (
-                event_execution_state.state,
-                update_timestamp,
-                event_execution_state.attempts.model_dump_json(),
-                event_id,
-                EventStateEnum.IN_PROGRESS,
-            ),
-        )
         if cursor.rowcount == 0:
             # This is quite an unexpected situation, as we should have locked the event before processing it.
             return False
         return True
 
-    @contextlib.contextmanager
-    def _lock_for_processing(
-        self, event_id: EventId
-    ) -> Generator[EventData, None, None]:
-        start_timestamp = None
-        execution_state = None
+    @contextlib.asynccontextmanager
+    async def _lock_for_processing(self, event_row: EventRow) -> AsyncIterator[str]:
+        """Yields JSON of the already acquired event and releases the event after processing."""
+        event_id = event_row.event_id
+        # The event was acquired right before the processing started.
+        start_timestamp = event_row.state_update_timestamp
         try:
-            event_row = self._acquire_event(event_id)
-            execution_state = event_row.execution_state
-            event_data = event_row.event_data
-            del event_row
-            start_timestamp = LocalUTCTimestamp(time.time())
-            yield event_data
+            yield event_row.event_json
         except Exception as exc:
-            if execution_state is None:
-                raise
-            if start_timestamp is not None:
-                execution_state.attempts.attempts.append(
-                    EventProcessingAttempt(
-                        start_timestamp=start_timestamp,
-                        finish_timestamp=LocalUTCTimestamp(time.time()),
-                        error=repr(exc),
-                    )
-                )
+            attempt = EventProcessingAttempt(
+                start_timestamp=start_timestamp,
+                finish_timestamp=LocalUTCTimestamp(time.time()),
+                error=repr(exc),
+            )
             # XXX: It's probably not a good idea to retry multiple times in a row without even some back-off strategy, but we want:
             # 1. To skip the event in case of error
             # 2. Process all events in order
-            if len(execution_state.attempts.attempts) >= self._options.max_attempts:
-                execution_state.state = EventStateEnum.ERROR
-            else:
-                execution_state.state = EventStateEnum.NEW
             try:
-                self._release_event(event_id, event_execution_state=execution_state)
+                await self._run_in_db_thread(self._release_event, event_id, attempt)
             except Exception:
                 logging.critical(
                     "Failed to release the event %r after error",
@@ -252,15 +276,12 @@ class SqliteEventQueue(BaseEventQueue):
                 )
             raise
         else:
-            execution_state.attempts.attempts.append(
-                EventProcessingAttempt(
-                    start_timestamp=start_timestamp,
-                    finish_timestamp=LocalUTCTimestamp(time.time()),
-                    error=None,
-                )
+            attempt = EventProcessingAttempt(
+                start_timestamp=start_timestamp,
+                finish_timestamp=LocalUTCTimestamp(time.time()),
+                error=None,
             )
-            execution_state.state = EventStateEnum.DONE
-            self._release_event(event_id, event_execution_state=execution_state)
+            await self._run_in_db_thread(self._release_event, event_id, attempt)
 
     @contextlib.asynccontextmanager
     async def get_event_for_processing(
@@ -268,58 +289,48 @@ class SqliteEventQueue(BaseEventQueue):
     ) -> AsyncIterator[BaseEvent | None]:
         """Waits at most timeout seconds for the next event and acquires it for processing."""
         while True:
-            new_event_ids = self._get_new_event_ids(1)
-            logging.debug("get_new_events: %r", new_event_ids)
-            if new_event_ids:
-                event_id = new_event_ids[0]
-                try:
-                    with self._lock_for_processing(event_id) as event_data:
-                        event = BaseEventSubclass.validate_json(event_data.event_json)
-                        assert isinstance(event, BaseEvent)
-                        yield event
-                except SqliteEventQueue.EventAcquireFailure:
-                    # The event was acquired by someone else. It shouldn't appear in the get_new_events in the next iteration.
-                    continue
-                else:
-                    return
+            event_row = await self._run_in_db_thread(self._pop_next_event)
+            logging.debug("pop_next_event: %r", event_row)
+            if event_row is not None:
+                async with self._lock_for_processing(event_row) as event_json:
+                    event = BaseEventSubclass.validate_json(event_json)
+                    yield event
+                return
             try:
                 # No events currently in the table.
-                async with self._new_events_available_cond:
-                    await asyncio.wait_for(
-                        self._new_events_available_cond.wait_for(
-                            lambda: self._new_events_available
-                        ),
-                        timeout=self._options.get_new_event_timeout,
-                    )
-                    self._new_events_available = False
+                await asyncio.wait_for(
+                    self._new_events_available.wait(),
+                    timeout=min(timeout, self._options.get_new_event_timeout),
+                )
+                self._new_events_available.clear()
             except TimeoutError:
                 yield None
                 break
 
     async def put_events(self, events: List[BaseEvent]) -> None:
-        """Returns event_id of the newly inserted event."""
+        await self._run_in_db_thread(self._insert_events, events)
+        self._new_events_available.set()
+
+    def _insert_events(self, events: List[BaseEvent]) -> None:
         state_update_timestamp = time.time()
-        attempts = EventProcessingAttempts(attempts=[])
+        attempts_json = EventProcessingAttempts(attempts=[]).model_dump_json()
+        rows = [
+            (
+                event.recv_timestamp,
+                event.event_type,
+                event.model_dump_json(),
+                state_update_timestamp,
+                attempts_json,
+            )
+            for event in events
+        ]
         cursor = self._conn.cursor()
         cursor.execute("BEGIN IMMEDIATE TRANSACTION")
         try:
-            for event in events:
-                cursor.execute(
-                    "INSERT INTO events (recv_timestamp, event_type, event_json, state, state_update_timestamp, attempts_json) VALUES (?, ?, ?, ?, ?, ?)",
-                    (
-                        event.recv_timestamp,
-                        event.event_type,
-                        event.model_dump_json(indent=2),
-                        EventStateEnum.NEW,
-                        state_update_timestamp,
-                        attempts.model_dump_json(indent=2),
-                    ),
-                )
+            cursor.executemany(_SQL_INSERT_EVENT, rows)
         except Exception:
             cursor.execute("ROLLBACK")
             raise
         else:
             cursor.execute("COMMIT")
-        async with self._new_events_available_cond:
-            self._new_events_available = True
-            self._new_events_available_cond.notify()
+        self._check_backlog()
@@ -1,5 +1,7 @@
-from pydantic import BaseModel, Field, TypeAdapter
-from typing import Literal, Annotated, Union, List
+from pydantic import BaseModel, ConfigDict, Field, TypeAdapter
+from typing import Any, Literal, Annotated, Union, List
+import functools
+import sys
 from dataclasses import dataclass
 import aiogram.types
 from welcome_bot_app.model import (
@@ -22,12 +24,24 @@ class BotApiUpdate:
 
 
 class BaseEvent(BaseModel):
-    """Base class for all events."""
+    """Base class for all events.
+
+    Events are immutable: they are shared between the event queue and the event log, which renders them later."""
+
+    # Validators of the subclasses are built on first use, the queue decodes events through BaseEventSubclass.
+    model_config = ConfigDict(frozen=True, defer_build=True)
 
     event_type: str = "BaseEvent"
     recv_timestamp: LocalUTCTimestamp
 
     @classmethod
+    def __pydantic_init_subclass__(cls, **kwargs: Any) -> None:
+        super().__pydantic_init_subclass__(**kwargs)
+        # A new subclass was defined, so the cached list is outdated.
+        BaseEvent.get_subclasses.cache_clear()
+
+    @classmethod
+    @functools.lru_cache(maxsize=None)
     def get_subclasses(cls) -> "tuple[type[BaseEvent], ...]":
         return tuple(cls.__subclasses__())
 
@@ -35,7 +49,10 @@ class BaseEvent(BaseModel):
 # Bot API events
 
 
-class BasicUserInfo(BaseModel):
+@dataclass(slots=True, frozen=True)
+class BasicUserInfo:
+    """Plain dataclass: built for every Bot API event, cheaper than a model."""
+
     is_bot: bool
     first_name: str
     last_name: str | None
@@ -51,7 +68,8 @@ class BotApiChatInfo(BaseModel):
     @classmethod
     def from_bot_api_chat(cls, chat: aiogram.types.Chat) -> "BotApiChatInfo":
         return cls(
-            chat_type=chat.type,
+            # A handful of distinct values, shared by all events.
+            chat_type=sys.intern(chat.type),
             title=chat.title,
             username=chat.username,
             first_name=chat.first_name,
@@ -160,6 +178,7 @@ class StopEvent(BaseEvent):
     event_type: Literal["StopEvent"] = "StopEvent"
 
 
-BaseEventSubclass = TypeAdapter(
+# Built once at import time: building the validator for the discriminated union is expensive.
+BaseEventSubclass: TypeAdapter[BaseEvent] = TypeAdapter(
     Annotated[Union[BaseEvent.get_subclasses()], Field(discriminator="event_type")]
 )
@@ -0,0 +1,31 @@
+import asyncio
+import time
+
+
+class RateLimiter:
+    """Token bucket allowing at most `max_rate` operations per `time_period` seconds."""
+
+    def __init__(self, max_rate: float, time_period: float = 1.0) -> None:
+        self._max_rate = max_rate
+        self._tokens_per_second = max_rate / time_period
+        self._tokens = max_rate
+        self._last_refill_time = time.monotonic()
+        # Waiters are served in FIFO order.
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(
+            self._max_rate,
+            self._tokens + (now - self._last_refill_time) * self._tokens_per_second,
+        )
+        self._last_refill_time = now
+
+    async def acquire(self) -> None:
+        """Waits until the operation is allowed."""
+        async with self._lock:
+            self._refill()
+            while self._tokens < 1.0:
+                await asyncio.sleep((1.0 - self._tokens) / self._tokens_per_second)
+                self._refill()
+            self._tokens -= 1.0
@@ -1,7 +1,11 @@
+import functools
 import html
 import re
 from typing import Mapping
 
+# Matches $PLACEHOLDERS in message templates, the group is the placeholder name.
+_SUBST_RE = re.compile(r"\$([A-Z_]+)")
+
 
 class safe_html_str(str):
     """A string that's safe to render in html."""
@@ -21,17 +25,32 @@ def safe_html_format(
     for k, v in dct.items():
         if not isinstance(v, safe_html_str):
             raise ValueError(f"Value {v} for key {k} is not safe.")
-    return safe_html_str(s.format(**dct))
+    return safe_html_str(s.format_map(dct))
+
+
+@functools.lru_cache(maxsize=256)
+def _compile_template(text: str) -> tuple[tuple[str, str | None], ...]:
+    """Splits the template into (literal, placeholder name or None) pairs."""
+    parts: list[tuple[str, str | None]] = []
+    last = 0
+    for m in _SUBST_RE.finditer(text):
+        parts.append((text[last : m.start()], m.group(1)))
+        last = m.end()
+    parts.append((text[last:], None))
+    return tuple(parts)
+
+
+def html_template_placeholders(text: str) -> frozenset[str]:
+    """Returns names of $PLACEHOLDERS used in the template."""
+    return frozenset(name for _, name in _compile_template(text) if name is not None)
 
 
 def substitute_html(
     text: safe_html_str, substitutions: Mapping[str, safe_html_str]
 ) -> safe_html_str:
-    parts = re.split(r"(\$[A-Z_]+)", text)
-    body: list[safe_html_str] = []
-    for part in parts:
-        if part.startswith("$") and part[1:] in substitutions:
-            body.append(substitutions[part[1:]])
-        else:
-            body.append(safe_html_str(part))
+    body: list[str] = []
+    for literal, name in _compile_template(text):
+        body.append(literal)
+        if name is not None:
+            body.append(substitutions.get(name, "$" + name))
     return safe_html_str("".join(body))
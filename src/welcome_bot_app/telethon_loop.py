@@ -1,39 +1,101 @@
 import logging
 import asyncio
 import time
+from typing import List
 import telethon
-from datetime import timezone
 from welcome_bot_app.model import (
     UserChatId,
     TelethonMessageId,
     TelethonUTCTimestamp,
     LocalUTCTimestamp,
 )
-from welcome_bot_app.model.events import TelethonNewTextMessage
+from welcome_bot_app.model.events import BaseEvent, TelethonNewTextMessage
 from welcome_bot_app.event_log import EventLog
 from welcome_bot_app.event_queue import BaseEventQueue
 
+# Telethon types are generated from the TL schema and are never subclassed, so exact type checks are enough.
+_PeerUser = telethon.types.PeerUser
+_PeerChat = telethon.types.PeerChat
+
+
+class _EventBatcher:
+    """Collects events and puts them into the event queue in batches, preserving their order."""
+
+    def __init__(
+        self,
+        event_queue: BaseEventQueue,
+        max_batch_size: int,
+        max_delay: float,
+        retry_delay: float,
+    ) -> None:
+        self._event_queue = event_queue
+        self._max_batch_size = max_batch_size
+        self._max_delay = max_delay
+        self._retry_delay = retry_delay
+        self._events: List[BaseEvent] = []
+        self._events_available = asyncio.Event()
+        self._stopped = False
+
+    def add(self, event: BaseEvent) -> None:
+        self._events.append(event)
+        self._events_available.set()
+
+    async def _flush(self) -> None:
+        while self._events:
+            batch = self._events[: self._max_batch_size]
+            await self._event_queue.put_events(batch)
+            # Removed only once they are in the queue, so that a failed batch is retried.
+            del self._events[: len(batch)]
+
+    async def run(self) -> None:
+        """Puts collected events into the queue until stop() is called, then puts the remaining ones."""
+        while not self._stopped:
+            await self._events_available.wait()
+            if not self._stopped:
+                # Give other events a chance to join the batch.
+                await asyncio.sleep(self._max_delay)
+            self._events_available.clear()
+            try:
+                await self._flush()
+            except Exception:
+                logging.error(
+                    "Failed to put %d events into the queue, retrying in %s seconds",
+                    len(self._events),
+                    self._retry_delay,
+                    exc_info=True,
+                )
+                await asyncio.sleep(self._retry_delay)
+                self._events_available.set()
+        await self._flush()
+
+    def stop(self) -> None:
+        self._stopped = True
+        self._events_available.set()
+
 
 async def telethon_main(
     client: telethon.TelegramClient,
     event_queue: BaseEventQueue,
     event_log: EventLog,
 ) -> None:
+    event_batcher = _EventBatcher(
+        event_queue, max_batch_size=32, max_delay=0.005, retry_delay=1.0
+    )
     try:
         async with client:
 
             @client.on(telethon.events.NewMessage)  # type: ignore
             async def new_message_handler(telethon_event) -> None:
                 recv_timestamp = LocalUTCTimestamp(time.time())
-                event_log.log_telethon_event(recv_timestamp, telethon_event)
-                if not isinstance(telethon_event.from_id, telethon.types.PeerUser):
+                if type(telethon_event.from_id) is not _PeerUser:
                     return
                 user_id = telethon_event.from_id.user_id
                 chat_id = None
-                if isinstance(telethon_event.peer_id, telethon.types.PeerUser):
+                peer_type = type(telethon_event.peer_id)
+                if peer_type is _PeerUser:
                     # This is a private message to the bot user account, we should simply ignore this.
                     return
-                elif isinstance(telethon_event.peer_id, telethon.types.PeerChat):
+                elif peer_type is _PeerChat:
                     chat_id = telethon_event.peer_id.chat_id
                     # Aiogram, or bot API represent this number as negative.
                     assert chat_id >= 0
@@ -41,6 +103,8 @@ async def telethon_main(
                 else:
                     return
                 assert chat_id is not None
+                # Only messages from users in group chats are logged, others are dropped above.
+                event_log.log_telethon_event(recv_timestamp, telethon_event)
                 user_chat_id = UserChatId(user_id=user_id, chat_id=chat_id)
                 if telethon_event.message.message is None:
                     return
@@ -49,12 +113,10 @@ async def telethon_main(
                     user_chat_id=user_chat_id,
                     text=telethon_event.message.message,
                     message_id=TelethonMessageId(telethon_event.message.id),
-                    tg_timestamp=TelethonUTCTimestamp(
-                        telethon_event.date.astimezone(timezone.utc).timestamp()
-                    ),
+                    tg_timestamp=TelethonUTCTimestamp(telethon_event.date.timestamp()),
                 )
                 event_log.log_base_event(recv_timestamp, event)
-                await event_queue.put_events([event])
+                event_batcher.add(event)
 
             # TODO: Handle other types of updates.
             # @client.on(telethon.events.MessageEdited)
@@ -66,10 +128,15 @@ async def telethon_main(
             # @client.on(telethon.events.ChatAction)
             # async def chat_action_handler(event):
             #     await event_queue.put(('TELETHON/CHATACTION', time.time(), event))
+            event_batcher_task = asyncio.create_task(event_batcher.run())
             try:
                 await client.run_until_disconnected()
             except asyncio.CancelledError:
                 logging.info("telethon_main cancelled")
+            finally:
+                # Not cancelled, so that a batch being put into the queue is neither lost nor put twice.
+                event_batcher.stop()
+                await event_batcher_task
     except:
         logging.error("Error in telethon_main", exc_info=True)
         raise
@@ -59,8 +59,27 @@ async def main() -> None:
     event_queue = SqliteEventQueue(
         db_path=args.event_queue_file, options=SqliteEventQueue.Options()
     )
-    event_log = EventLog(args.event_log_file)
-    await telethon_loop.telethon_main(telethon_client, event_queue, event_log)
+    event_log = EventLog(args.event_log_file, options=EventLog.Options())
+    try:
+        all_tasks = [
+            asyncio.create_task(
+                telethon_loop.telethon_main(telethon_client, event_queue, event_log)
+            ),
+            asyncio.create_task(event_log.flush_periodically()),
+        ]
+        # flush_periodically() never returns, so the main loop finishing must stop it.
+        done, pending = await asyncio.wait(
+            all_tasks, return_when=asyncio.FIRST_COMPLETED
+        )
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        for task in done:
+            # Re-raises the error of the finished task, if any.
+            task.result()
+    finally:
+        event_log.close()
+        event_queue.close()
 
 
 if __name__ == "__main__":